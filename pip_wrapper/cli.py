@@ -1,18 +1,48 @@
 import subprocess
 import sys
 import os
-import toml
 import json
 from datetime import datetime
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import sysconfig
 import time
-from threading import Lock
+from threading import Lock, Thread
+import queue
+
+try:
+    import tomllib
+    import tomli_w
+except ImportError:  # Python < 3.11: fall back to the pure-Python toml package
+    tomllib = None
+    import toml
+
+try:
+    from importlib import metadata as importlib_metadata
+except ImportError:  # Python < 3.8
+    importlib_metadata = None
 
 PYPROJECT_FILE = "pyproject.toml"
 LOG_FILE = "installed_packages.json"
 file_lock = Lock()  # For thread-safe file operations
+RECONCILE_DEBOUNCE_SECONDS = 0.5  # Quiet period before reconciling after filesystem events
+
+
+def load_pyproject():
+    """Read and parse pyproject.toml."""
+    if tomllib is not None:
+        with open(PYPROJECT_FILE, "rb") as f:
+            return tomllib.load(f)
+    with open(PYPROJECT_FILE, "r") as f:
+        return toml.load(f)
+
+
+def save_pyproject(project_data):
+    """Serialize project_data to pyproject.toml in a single write."""
+    content = tomli_w.dumps(project_data) if tomllib is not None else toml.dumps(project_data)
+    with file_lock:
+        with open(PYPROJECT_FILE, "w") as f:
+            f.write(content)
 
 
 def create_pyproject():
@@ -34,8 +64,7 @@ def create_pyproject():
         }
     }
 
-    with open(PYPROJECT_FILE, "w") as f:
-        toml.dump(project_data, f)
+    save_pyproject(project_data)
 
     print(f"{PYPROJECT_FILE} created successfully.")
 
@@ -54,9 +83,13 @@ def debug_toml_state():
         debug("pyproject.toml does not exist.")
 
 
+# The interpreter's prefixes cannot change while running, so evaluate this once
+IS_VIRTUAL_ENV = hasattr(sys, 'real_prefix') or (hasattr(sys, 'base_prefix') and sys.base_prefix != sys.prefix)
+
+
 def is_virtual_env():
     """Check if the script is running in a virtual environment."""
-    return hasattr(sys, 'real_prefix') or (hasattr(sys, 'base_prefix') and sys.base_prefix != sys.prefix)
+    return IS_VIRTUAL_ENV
 
 
 def initialize_pyproject():
@@ -66,17 +99,74 @@ def initialize_pyproject():
         create_pyproject()
 
 
-def get_installed_packages():
-    """Retrieve installed packages using pip freeze."""
+# Packages hidden by pip freeze; build backends are only hidden before Python 3.12
+FREEZE_EXCLUDES = {"pip"} | ({"setuptools", "wheel", "distribute"} if sys.version_info < (3, 12) else set())
+_freeze_cache = {"mtime": None, "packages": {}}  # Last scan result, keyed on site-packages mtime
+
+
+def get_site_packages_mtime():
+    """Return the site-packages directory mtime, or None if it cannot be read."""
+    try:
+        return os.stat(sysconfig.get_paths()["purelib"]).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _pip_freeze():
+    """Enumerate installed packages through a pip freeze subprocess (Python < 3.8 fallback)."""
     result = subprocess.run([sys.executable, "-m", "pip", "freeze"], capture_output=True, text=True)
     packages = {}
     for line in result.stdout.splitlines():
-        if "==" in line:
-            name, version = line.split("==")
+        # Comment lines annotate editable installs, e.g. "# Editable install ... (pkg==1.0)"
+        if line.startswith("#"):
+            continue
+        name, sep, version = line.partition("==")
+        if sep:
             packages[name] = version
     return packages
 
 
+def _iter_distributions():
+    """Yield (name, distribution) for each installed distribution, first match on sys.path winning as in pip."""
+    seen = set()
+    for dist in importlib_metadata.distributions():
+        name = dist.metadata["Name"]
+        if not name:
+            continue
+        key = name.lower()
+        if key in seen:
+            continue
+        seen.add(key)
+        yield name, dist
+
+
+def _scan_distributions():
+    """Enumerate installed packages in-process, keeping only what pip freeze lists as name==version."""
+    packages = {}
+    for name, dist in _iter_distributions():
+        if name.lower() in FREEZE_EXCLUDES:
+            continue
+        # Editable and direct-URL installs (pip freeze's "-e ..." / "name @ url" lines) cannot be pinned
+        if dist.read_text("direct_url.json") is not None:
+            continue
+        packages[name] = dist.version
+    return packages
+
+
+def get_installed_packages():
+    """Retrieve installed packages, reusing the last result if site-packages is unchanged."""
+    mtime = get_site_packages_mtime()
+    if mtime is not None and mtime == _freeze_cache["mtime"]:
+        return dict(_freeze_cache["packages"])
+
+    packages = _pip_freeze() if importlib_metadata is None else _scan_distributions()
+
+    if packages:
+        _freeze_cache["mtime"] = mtime
+        _freeze_cache["packages"] = packages
+    return dict(packages)
+
+
 def backup_pyproject():
     """Create a backup of pyproject.toml."""
     if os.path.exists(PYPROJECT_FILE):
@@ -103,8 +193,7 @@ def reconcile_installed_packages(skip_empty=False):
         return
 
     # Load existing dependencies from pyproject.toml
-    with open(PYPROJECT_FILE, "r") as f:
-        project_data = toml.load(f)
+    project_data = load_pyproject()
 
     dependencies = project_data.setdefault("tool", {}).setdefault("custom", {}).setdefault("dependencies", {})
 
@@ -125,31 +214,107 @@ def reconcile_installed_packages(skip_empty=False):
         debug(f"Removing {package} from in-memory state.")
         del global_dependencies_state[package]
 
+    # Skip the write entirely when pyproject.toml already matches the in-memory state
+    if dependencies == global_dependencies_state:
+        debug("pyproject.toml already up to date. Reconciliation complete.")
+        return
+
     # Write the in-memory state back to pyproject.toml
     dependencies.clear()
     dependencies.update(global_dependencies_state)
 
-    with file_lock:
-        with open(PYPROJECT_FILE, "w") as f:
-            toml.dump(project_data, f)
+    save_pyproject(project_data)
 
     debug("Reconciliation complete.")
     debug_toml_state()
 
 
+def is_pyproject_path(path):
+    """Check whether a filesystem event path refers to pyproject.toml."""
+    return os.path.basename(path) == PYPROJECT_FILE
+
+
+METADATA_SUFFIXES = (".dist-info", ".egg-info")  # Installed distribution metadata entries
+
+
+def is_relevant_path(path):
+    """Check whether a filesystem event path signals an install, uninstall or pyproject.toml edit."""
+    path = path.rstrip(os.sep)
+    if path.endswith(METADATA_SUFFIXES) or any(suffix + os.sep in path for suffix in METADATA_SUFFIXES):
+        return True
+    return is_pyproject_path(path)
+
+
 class InstallEventHandler(FileSystemEventHandler):
-    def __init__(self):
+    def __init__(self, debounce_seconds=RECONCILE_DEBOUNCE_SECONDS):
         super().__init__()
         self.shutdown_flag = False
+        self.debounce_seconds = debounce_seconds
+        # At most one pending request; duplicates are dropped while one is queued
+        self._pending = queue.Queue(maxsize=1)
+        self._worker = Thread(target=self._reconcile_worker, name="reconcile-worker", daemon=True)
+
+    def on_created(self, event):
+        self._handle_event(event, event.src_path)
+
+    def on_deleted(self, event):
+        self._handle_event(event, event.src_path)
+
+    def on_modified(self, event):
+        # Only pyproject.toml edits matter; metadata contents are written once on install
+        if is_pyproject_path(event.src_path):
+            self._handle_event(event, event.src_path)
+
+    def on_moved(self, event):
+        # pip stashes uninstalled files by renaming them, so check both ends of the move
+        path = event.src_path if is_relevant_path(event.src_path) else event.dest_path
+        self._handle_event(event, path)
+
+    def _handle_event(self, event, path):
+        if not is_relevant_path(path):
+            return
 
-    def on_any_event(self, event):
         if self.shutdown_flag:
             debug("Skipping event handling due to shutdown.")
             return
 
-        if event.event_type in {"created", "modified", "deleted"}:
-            debug(f"Event detected: {event.event_type} on {event.src_path}")
-            reconcile_installed_packages()
+        debug(f"Event detected: {event.event_type} on {path}")
+        self.schedule_reconcile()
+
+    def schedule_reconcile(self):
+        """Request a reconciliation; a no-op if one is already pending."""
+        try:
+            self._pending.put_nowait(True)
+        except queue.Full:
+            pass
+
+    def start(self):
+        """Start the worker thread that runs reconciliations one at a time."""
+        self._worker.start()
+
+    def stop(self):
+        """Drop pending reconciliations and wait for the worker to finish."""
+        self.shutdown_flag = True
+        self.schedule_reconcile()  # Wake the worker so it notices the shutdown
+        if self._worker.is_alive():
+            self._worker.join()
+
+    def _reconcile_worker(self):
+        while True:
+            self._pending.get()
+            # Wait for a quiet period so a burst of events leads to one reconciliation
+            while not self.shutdown_flag:
+                try:
+                    self._pending.get(timeout=self.debounce_seconds)
+                except queue.Empty:
+                    break
+            if self.shutdown_flag:
+                return
+            # Keep the worker alive on failure (e.g. a half-saved pyproject.toml) so later events still reconcile
+            try:
+                reconcile_installed_packages()
+            except Exception as e:
+                debug(f"Reconciliation failed: {e}")
 
 
 def monitor_virtualenv():
@@ -164,10 +329,12 @@ def monitor_virtualenv():
     event_handler = InstallEventHandler()
     observer = Observer()
 
-    # Monitor site-packages and pyproject.toml
-    observer.schedule(event_handler, site_packages_dir, recursive=True)
+    # Monitor site-packages and pyproject.toml. Installs and uninstalls always add or
+    # remove a top-level *.dist-info/*.egg-info entry, so site-packages needs no recursion.
+    observer.schedule(event_handler, site_packages_dir, recursive=False)
     observer.schedule(event_handler, ".", recursive=False)
 
+    event_handler.start()
     observer.start()
     try:
         print("Monitoring started. Press Ctrl+C to stop.")
@@ -179,6 +346,7 @@ def monitor_virtualenv():
         observer.stop()
     finally:
         observer.join()
+        event_handler.stop()
         print("Monitoring stopped. No changes made during shutdown.")
 
 
@@ -194,19 +362,22 @@ def install_dependencies_from_pyproject():
         print("Error: pyproject.toml does not exist. Cannot install dependencies.")
         return
 
-    with open(PYPROJECT_FILE, "r") as f:
-        project_data = toml.load(f)
+    project_data = load_pyproject()
 
     dependencies = project_data.get("tool", {}).get("custom", {}).get("dependencies", {})
     if not dependencies:
         print("No dependencies listed in pyproject.toml.")
         return
 
+    # Install everything in a single pip invocation (one resolver pass)
+    pkg_specs = [f"{package}=={version}" if version else package for package, version in dependencies.items()]
     print("Installing dependencies from pyproject.toml...")
-    for package, version in dependencies.items():
-        pkg_str = f"{package}=={version}" if version else package
-        print(f"Installing {pkg_str}...")
-        subprocess.run([sys.executable, "-m", "pip", "install", pkg_str])
+    print(f"Installing {', '.join(pkg_specs)}...")
+    result = subprocess.run([sys.executable, "-m", "pip", "install", *pkg_specs])
+    if result.returncode != 0:
+        print(f"Error: pip install failed with exit code {result.returncode}.")
+        return
+
     print("Dependencies installation complete.")
 
 
@@ -220,8 +391,7 @@ def clear_dependencies():
         print(f"Error: {PYPROJECT_FILE} does not exist. Nothing to clear.")
         return
 
-    with open(PYPROJECT_FILE, "r") as f:
-        project_data = toml.load(f)
+    project_data = load_pyproject()
 
     # Navigate to the dependencies section
     dependencies = project_data.get("tool", {}).get("custom", {}).get("dependencies", None)
@@ -234,9 +404,7 @@ def clear_dependencies():
     project_data["tool"]["custom"]["dependencies"] = {}
 
     # Save changes to pyproject.toml
-    with file_lock:
-        with open(PYPROJECT_FILE, "w") as f:
-            toml.dump(project_data, f)
+    save_pyproject(project_data)
 
     print("All dependencies cleared from pyproject.toml.")
     debug_toml_state()
@@ -24,7 +24,8 @@ setup(
         ]
     },
     install_requires=[
-        "toml>=0.10.0",        # TOML support for pyproject
+        "toml>=0.10.0; python_version < '3.11'",    # TOML support for pyproject (pre-tomllib)
+        "tomli-w>=1.0.0; python_version >= '3.11'",  # TOML writer paired with stdlib tomllib
         "watchdog>=2.1.0",     # Required for filesystem monitoring
         "setuptools>=42",      # Required for building wheels
         "wheel>=0.36.2",       # Needed to handle Python wheel packaging